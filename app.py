@@ -1,11 +1,15 @@
+import csv
+import io
+import math
 import streamlit as st
-import pandas as pd
+from collections import deque
 from datetime import datetime
 from database import (
-    init_database, get_all_patients, get_all_logs, 
+    init_database, iter_logs, get_logs_since, get_patients_version,
+    count_patients, get_patients_page, get_patient_ids, get_patient_by_id, iter_patients,
     add_patient, update_patient, anonymize_all_patients
 )
-from auth import authenticate_user, check_role, log_user_action
+from auth import authenticate_user, check_role, log_user_action, flush_logs, get_failed_logs
 from crypto_utils import get_cipher, mask_name, mask_contact, decrypt_field
 
 # Page configuration
@@ -16,6 +20,10 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+PATIENTS_PAGE_SIZE = 50
+PATIENTS_PAGE_CACHE_SIZE = 20  # recently viewed pages kept in memory
+AUDIT_LOG_TAIL_SIZE = 10000
+
 # Initialize database on first run
 init_database()
 
@@ -25,27 +33,101 @@ if 'user' not in st.session_state:
 if 'page' not in st.session_state:
     st.session_state['page'] = 'Login'
 
+# Audit log tail - logs are append-only, so only rows after last_log_id are fetched
+if 'log_cache' not in st.session_state:
+    st.session_state['log_cache'] = deque(maxlen=AUDIT_LOG_TAIL_SIZE)
+    st.session_state['log_columns'] = []
+    st.session_state['last_log_id'] = 0
+
 # System uptime (availability indicator)
 if 'start_time' not in st.session_state:
     st.session_state['start_time'] = datetime.now()
 
 # ========== HELPER FUNCTIONS ==========
 
+@st.cache_data(show_spinner=False, max_entries=1)
+def _cached_patient_ids(version):
+    """Patient IDs for selectors, cached until the data version changes"""
+    return get_patient_ids()
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _cached_patient_count(version):
+    """Patient count, cached until the data version changes"""
+    return count_patients()
+
+@st.cache_data(show_spinner=False, max_entries=PATIENTS_PAGE_CACHE_SIZE)
+def _cached_patients_page(version, offset, limit):
+    """One page of patients as a DataFrame, cached until the data version changes"""
+    import pandas as pd  # lazy - login-only sessions never load pandas
+    columns, rows = get_patients_page(offset, limit)
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+def _refresh_log_tail():
+    """Append audit logs written since the last refresh to the session's bounded tail"""
+    columns, rows = get_logs_since(st.session_state['last_log_id'], AUDIT_LOG_TAIL_SIZE)
+    st.session_state['log_columns'] = columns
+    if rows:
+        st.session_state['log_cache'].extend(rows)
+        st.session_state['last_log_id'] = rows[-1][0]
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def _cached_logs(last_log_id, columns, _rows):
+    """Audit log DataFrame (newest first) plus filter group indices, cached per last_log_id"""
+    import pandas as pd  # lazy - login-only sessions never load pandas
+    df = pd.DataFrame.from_records(list(reversed(_rows)), columns=columns)
+    df['action'] = df['action'].astype('category')
+    df['role'] = df['role'].astype('category')
+    # Row positions per filter value, so filtering is a dict lookup instead of a mask scan
+    groups = {
+        'action': df.groupby('action', observed=True).indices,
+        'role': df.groupby('role', observed=True).indices,
+        'action_role': df.groupby(['action', 'role'], observed=True).indices,
+    }
+    return df, groups
+
+# Exports hold full (raw) data, so only the latest one is kept in memory
+@st.cache_data(show_spinner=False, max_entries=1)
+def _patients_csv(version):
+    """Patient CSV export bytes, re-encoded only when the data version changes"""
+    return rows_to_csv(iter_patients())
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _logs_csv(last_log_id):
+    """Audit log CSV export up to last_log_id (the page's refresh point, not moved by its own logging)"""
+    return rows_to_csv(iter_logs(last_log_id))
+
+@st.cache_resource
+def _cached_cipher():
+    """Fernet cipher shared across reruns (avoids re-reading the key file)"""
+    return get_cipher()
+
 def logout():
     """Logout and clear session"""
     if st.session_state['user']:
         log_user_action(st.session_state, "LOGOUT", "User logged out")
+        flush_logs()
     st.session_state['user'] = None
     st.session_state['page'] = 'Login'
     st.rerun()
 
+def rows_to_csv(batches):
+    """Encode (columns, rows) batches as CSV bytes (rows are fetched in batches; the CSV is built in memory)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    header_written = False
+    for columns, rows in batches:
+        if not header_written:
+            writer.writerow(columns)
+            header_written = True
+        writer.writerows(rows)
+    return buf.getvalue().encode('utf-8')
+
 def export_to_csv(data, filename):
-    """Export data to CSV for availability and backup (GDPR Article 5)"""
-    df = pd.DataFrame(data)
-    csv = df.to_csv(index=False)
+    """Export CSV bytes for availability and backup (GDPR Article 5)"""
     st.download_button(
         label=f"📥 Download {filename}",
-        data=csv,
+        data=data,
+        # Own clock read: this also renders inside fragments, where main()'s '_now' is stale
         file_name=f"{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
         mime="text/csv"
     )
@@ -92,6 +174,13 @@ def login_page():
 
 # ========== DASHBOARD PAGE ==========
 
+# Dashboard banner (element, message) per role
+ROLE_BANNERS = {
+    'admin': (st.success, "🔓 **Admin Access**: Full system control, raw data access, audit logs"),
+    'doctor': (st.info, "👨‍⚕️ **Doctor Access**: View anonymized patient data only"),
+    'receptionist': (st.warning, "📝 **Receptionist Access**: Add/edit records, no sensitive data view"),
+}
+
 def dashboard_page():
     """Main dashboard with role-based welcome (RBAC)"""
     user = st.session_state['user']
@@ -106,18 +195,14 @@ def dashboard_page():
     with col2:
         st.metric("🔑 Access Level", user['role'].capitalize())
     with col3:
-        uptime = datetime.now() - st.session_state['start_time']
+        uptime = st.session_state['_now'] - st.session_state['start_time']
         st.metric("⏱️ System Uptime", f"{uptime.seconds // 60} mins")
     
     st.divider()
     
     # Role-specific instructions (GDPR transparency)
-    if user['role'] == 'admin':
-        st.success("🔓 **Admin Access**: Full system control, raw data access, audit logs")
-    elif user['role'] == 'doctor':
-        st.info("👨‍⚕️ **Doctor Access**: View anonymized patient data only")
-    else:
-        st.warning("📝 **Receptionist Access**: Add/edit records, no sensitive data view")
+    show_banner, message = ROLE_BANNERS.get(user['role'], ROLE_BANNERS['receptionist'])
+    show_banner(message)
     
     log_user_action(st.session_state, "VIEW_DASHBOARD", "Accessed dashboard")
 
@@ -130,105 +215,117 @@ def patients_page():
     
     tab1, tab2, tab3 = st.tabs(["📋 View Patients", "➕ Add Patient", "🔄 Update Patient"])
     
-    # TAB 1: View Patients
+    # Each tab is a fragment - its widgets rerun only that tab, not the whole page
     with tab1:
-        st.subheader("Patient List")
+        _view_patients_tab(user)
+    with tab2:
+        _add_patient_tab(user)
+    with tab3:
+        _update_patient_tab(user)
+
+@st.fragment
+def _view_patients_tab(user):
+    """TAB 1: View Patients"""
+    st.subheader("Patient List")
+    
+    version = get_patients_version()
+    total = _cached_patient_count(version)
+    if total:
+        # Server-side pagination - only the visible slice is fetched
+        total_pages = math.ceil(total / PATIENTS_PAGE_SIZE)
+        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
+        offset = (page - 1) * PATIENTS_PAGE_SIZE
+        df = _cached_patients_page(version, offset, PATIENTS_PAGE_SIZE)
+        st.caption(f"Showing {offset + 1}-{offset + len(df)} of {total} patients")
         
-        patients = get_all_patients()
-        if patients:
-            # Role-based data display (RBAC for confidentiality)
-            if user['role'] == 'admin':
-                view_mode = st.radio("View Mode (Admin Only):", ["Anonymized", "Raw Data"], horizontal=True)
-                
-                if view_mode == "Raw Data":
-                    st.warning("⚠️ Viewing raw patient data - ensure GDPR compliance")
-                    log_user_action(st.session_state, "VIEW_RAW_DATA", "Admin viewed raw patient data")
-                    
-                    df = pd.DataFrame([dict(p) for p in patients])
-                    st.dataframe(df[['patient_id', 'name', 'contact', 'diagnosis', 'date_added']], use_container_width=True)
-                else:
-                    df = pd.DataFrame([dict(p) for p in patients])
-                    st.dataframe(df[['patient_id', 'anonymized_name', 'anonymized_contact', 'diagnosis', 'date_added']], use_container_width=True)
-                
-                export_to_csv([dict(p) for p in patients], "patients_data")
+        # Role-based data display (RBAC for confidentiality)
+        if user['role'] == 'admin':
+            view_mode = st.radio("View Mode (Admin Only):", ["Anonymized", "Raw Data"], horizontal=True)
             
-            elif user['role'] == 'doctor':
-                st.info("👨‍⚕️ Viewing anonymized data (GDPR compliant)")
-                log_user_action(st.session_state, "VIEW_ANONYMIZED_DATA", "Doctor viewed anonymized data")
+            if view_mode == "Raw Data":
+                st.warning("⚠️ Viewing raw patient data - ensure GDPR compliance")
+                log_user_action(st.session_state, "VIEW_RAW_DATA", "Admin viewed raw patient data")
                 
-                df = pd.DataFrame([dict(p) for p in patients])
+                st.dataframe(df[['patient_id', 'name', 'contact', 'diagnosis', 'date_added']], use_container_width=True)
+            else:
                 st.dataframe(df[['patient_id', 'anonymized_name', 'anonymized_contact', 'diagnosis', 'date_added']], use_container_width=True)
             
-            else:
-                st.warning("🚫 Receptionists cannot view patient records (confidentiality)")
-        else:
-            st.info("No patient records found")
-    
-    # TAB 2: Add Patient
-    with tab2:
-        if user['role'] in ['admin', 'receptionist']:
-            st.subheader("Add New Patient")
+            export_to_csv(_patients_csv(version), "patients_data")
+        
+        elif user['role'] == 'doctor':
+            st.info("👨‍⚕️ Viewing anonymized data (GDPR compliant)")
+            log_user_action(st.session_state, "VIEW_ANONYMIZED_DATA", "Doctor viewed anonymized data")
             
-            with st.form("add_patient_form"):
-                name = st.text_input("Full Name*")
-                contact = st.text_input("Contact Number*")
-                diagnosis = st.text_area("Diagnosis*")
-                submit = st.form_submit_button("Add Patient", use_container_width=True)
-                
-                if submit:
-                    if name and contact and diagnosis:
-                        # Generate anonymized fields (GDPR pseudonymisation)
-                        cipher = get_cipher()
-                        anon_name = mask_name(999)  # Temp ID, will update after insert
-                        anon_contact = mask_contact(contact)
-                        
-                        # Optional encryption (bonus)
-                        enc_name = cipher.encrypt(name.encode()).decode()
-                        enc_contact = cipher.encrypt(contact.encode()).decode()
-                        
-                        pid = add_patient(name, contact, diagnosis, anon_name, anon_contact, enc_name, enc_contact)
-                        
-                        # Update with correct anonymized name
-                        update_patient(pid, name, contact, diagnosis, mask_name(pid), anon_contact)
-                        
-                        log_user_action(st.session_state, "ADD_PATIENT", f"Added patient ID {pid}")
-                        st.success(f"✅ Patient added successfully (ID: {pid})")
-                        st.rerun()
-                    else:
-                        st.error("❌ All fields are required")
+            st.dataframe(df[['patient_id', 'anonymized_name', 'anonymized_contact', 'diagnosis', 'date_added']], use_container_width=True)
+        
         else:
-            st.error("🚫 Doctors cannot add patients (integrity control)")
-    
-    # TAB 3: Update Patient
-    with tab3:
-        if user['role'] in ['admin', 'receptionist']:
-            st.subheader("Update Patient Record")
+            st.warning("🚫 Receptionists cannot view patient records (confidentiality)")
+    else:
+        st.info("No patient records found")
+
+@st.fragment
+def _add_patient_tab(user):
+    """TAB 2: Add Patient"""
+    if user['role'] in ['admin', 'receptionist']:
+        st.subheader("Add New Patient")
+        
+        with st.form("add_patient_form"):
+            name = st.text_input("Full Name*")
+            contact = st.text_input("Contact Number*")
+            diagnosis = st.text_area("Diagnosis*")
+            submit = st.form_submit_button("Add Patient", use_container_width=True)
             
-            patients = get_all_patients()
-            if patients:
-                patient_ids = [p['patient_id'] for p in patients]
-                selected_id = st.selectbox("Select Patient ID", patient_ids)
-                
-                selected_patient = next(p for p in patients if p['patient_id'] == selected_id)
+            if submit:
+                if name and contact and diagnosis:
+                    # Generate anonymized fields (GDPR pseudonymisation)
+                    # Anonymized name is derived from the new ID inside add_patient
+                    cipher = _cached_cipher()
+                    anon_contact = mask_contact(contact)
+                    
+                    # Optional encryption (bonus)
+                    enc_name = cipher.encrypt(name.encode()).decode()
+                    enc_contact = cipher.encrypt(contact.encode()).decode()
+                    
+                    pid = add_patient(name, contact, diagnosis, anon_contact, enc_name, enc_contact)
+                    
+                    log_user_action(st.session_state, "ADD_PATIENT", f"Added patient ID {pid}")
+                    st.success(f"✅ Patient added successfully (ID: {pid})")
+                    st.rerun()
+                else:
+                    st.error("❌ All fields are required")
+    else:
+        st.error("🚫 Doctors cannot add patients (integrity control)")
+
+@st.fragment
+def _update_patient_tab(user):
+    """TAB 3: Update Patient"""
+    if user['role'] in ['admin', 'receptionist']:
+        st.subheader("Update Patient Record")
+        
+        patient_ids = _cached_patient_ids(get_patients_version())
+        if patient_ids:
+            selected_id = st.selectbox("Select Patient ID", patient_ids)
+            
+            selected_patient = get_patient_by_id(selected_id)
+            
+            with st.form("update_patient_form"):
+                name = st.text_input("Full Name", value=selected_patient['name'])
+                contact = st.text_input("Contact", value=selected_patient['contact'])
+                diagnosis = st.text_area("Diagnosis", value=selected_patient['diagnosis'])
+                submit = st.form_submit_button("Update Patient", use_container_width=True)
                 
-                with st.form("update_patient_form"):
-                    name = st.text_input("Full Name", value=selected_patient['name'])
-                    contact = st.text_input("Contact", value=selected_patient['contact'])
-                    diagnosis = st.text_area("Diagnosis", value=selected_patient['diagnosis'])
-                    submit = st.form_submit_button("Update Patient", use_container_width=True)
+                if submit:
+                    anon_name = mask_name(selected_id)
+                    anon_contact = mask_contact(contact)
+                    update_patient(selected_id, name, contact, diagnosis, anon_name, anon_contact)
                     
-                    if submit:
-                        anon_name = mask_name(selected_id)
-                        anon_contact = mask_contact(contact)
-                        update_patient(selected_id, name, contact, diagnosis, anon_name, anon_contact)
-                        
-                        log_user_action(st.session_state, "UPDATE_PATIENT", f"Updated patient ID {selected_id}")
-                        st.success("✅ Patient updated successfully")
-                        st.rerun()
-            else:
-                st.info("No patients to update")
+                    log_user_action(st.session_state, "UPDATE_PATIENT", f"Updated patient ID {selected_id}")
+                    st.success("✅ Patient updated successfully")
+                    st.rerun()
         else:
-            st.error("🚫 Doctors cannot update patients (integrity control)")
+            st.info("No patients to update")
+    else:
+        st.error("🚫 Doctors cannot update patients (integrity control)")
 
 # ========== ANONYMIZATION PAGE ==========
 
@@ -246,7 +343,7 @@ def anonymization_page():
     with col1:
         st.subheader("Anonymize All Patients")
         if st.button("🔒 Apply Anonymization", use_container_width=True):
-            cipher = get_cipher()
+            cipher = _cached_cipher()
             anonymize_all_patients(cipher)
             log_user_action(st.session_state, "ANONYMIZE_ALL", "Batch anonymization applied with encryption")
             st.success("✅ All patients anonymized and encrypted")
@@ -254,14 +351,13 @@ def anonymization_page():
     
     with col2:
         st.subheader("Decrypt Patient Data")
-        patients = get_all_patients()
-        if patients:
-            patient_ids = [p['patient_id'] for p in patients]
+        patient_ids = _cached_patient_ids(get_patients_version())
+        if patient_ids:
             selected_id = st.selectbox("Select Patient", patient_ids)
             
             if st.button("🔓 Decrypt & View", use_container_width=True):
-                patient = next(p for p in patients if p['patient_id'] == selected_id)
-                cipher = get_cipher()
+                patient = get_patient_by_id(selected_id)
+                cipher = _cached_cipher()
                 
                 decrypted_name = decrypt_field(cipher, patient['encrypted_name'])
                 decrypted_contact = decrypt_field(cipher, patient['encrypted_contact'])
@@ -283,13 +379,24 @@ def audit_logs_page():
     st.title("📜 Integrity Audit Log")
     st.info("**GDPR Article 5(2)**: Accountability through comprehensive logging")
     
-    logs = get_all_logs()
+    # Refresh the tail only on page entry or on request - filter changes reuse the cached frame
+    entering = st.session_state.get('_rendered_page') != 'Audit Logs'
+    if st.button("🔄 Refresh Logs") or entering:
+        flush_logs()
+        _refresh_log_tail()
     
-    if logs:
-        df = pd.DataFrame([dict(log) for log in logs])
+    failed_logs = get_failed_logs()
+    if failed_logs:
+        st.error(f"⚠️ {len(failed_logs)} audit log entries could not be written - see server log")
+    
+    df, groups = _cached_logs(
+        st.session_state['last_log_id'], st.session_state['log_columns'], st.session_state['log_cache']
+    )
+    
+    if not df.empty:
         st.dataframe(df, use_container_width=True)
         
-        export_to_csv([dict(log) for log in logs], "audit_logs")
+        export_to_csv(_logs_csv(st.session_state['last_log_id']), "audit_logs")
         
         # Filter logs
         st.subheader("Filter Logs")
@@ -299,11 +406,14 @@ def audit_logs_page():
         with col2:
             filter_role = st.selectbox("Role", ["All"] + list(df['role'].unique()))
         
-        filtered_df = df
-        if filter_action != "All":
-            filtered_df = filtered_df[filtered_df['action'] == filter_action]
-        if filter_role != "All":
-            filtered_df = filtered_df[filtered_df['role'] == filter_role]
+        if filter_action != "All" and filter_role != "All":
+            filtered_df = df.iloc[groups['action_role'].get((filter_action, filter_role), [])]
+        elif filter_action != "All":
+            filtered_df = df.iloc[groups['action'][filter_action]]
+        elif filter_role != "All":
+            filtered_df = df.iloc[groups['role'][filter_role]]
+        else:
+            filtered_df = df
         
         st.dataframe(filtered_df, use_container_width=True)
         
@@ -313,8 +423,19 @@ def audit_logs_page():
 
 # ========== MAIN NAVIGATION ==========
 
+# Page name -> render function (access checks live inside each page)
+PAGES = {
+    'Dashboard': dashboard_page,
+    'Patients': patients_page,
+    'Anonymization': anonymization_page,
+    'Audit Logs': audit_logs_page,
+}
+
 def main():
     """Main application router with RBAC navigation"""
+    # One clock read per rerun, shared by every widget that shows the time
+    now = datetime.now()
+    st.session_state['_now'] = now
     
     if st.session_state['user'] is None:
         login_page()
@@ -335,10 +456,10 @@ def main():
                 pages['Anonymization'] = '🔐'
                 pages['Audit Logs'] = '📜'
             
+            # Routing happens below in the same run, so no extra st.rerun() is needed
             for page, icon in pages.items():
                 if st.button(f"{icon} {page}", use_container_width=True):
                     st.session_state['page'] = page
-                    st.rerun()
             
             st.divider()
             
@@ -350,21 +471,14 @@ def main():
             st.caption(f"🔑 {user['role'].capitalize()}")
             
             # System info (availability)
-            uptime = datetime.now() - st.session_state['start_time']
+            uptime = now - st.session_state['start_time']
             st.caption(f"⏱️ Uptime: {uptime.seconds // 60}m")
             st.caption("🔒 GDPR Compliant")
         
         # Page routing
         page = st.session_state.get('page', 'Dashboard')
-        
-        if page == 'Dashboard':
-            dashboard_page()
-        elif page == 'Patients':
-            patients_page()
-        elif page == 'Anonymization':
-            anonymization_page()
-        elif page == 'Audit Logs':
-            audit_logs_page()
+        PAGES.get(page, dashboard_page)()
+        st.session_state['_rendered_page'] = page
         
         # Footer (availability indicator)
         st.divider()
@@ -374,7 +488,7 @@ def main():
         with col2:
             st.caption("📜 GDPR Article 5 Compliant")
         with col3:
-            st.caption(f"🕒 Last Sync: {datetime.now().strftime('%H:%M:%S')}")
+            st.caption(f"🕒 Last Sync: {now.strftime('%H:%M:%S')}")
 
 if __name__ == "__main__":
     main()
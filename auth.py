@@ -1,6 +1,18 @@
 import sqlite3
+import queue
+import threading
+import time
 import bcrypt
-from database import get_db_connection, add_log
+from datetime import datetime
+from database import get_db_connection, add_logs
+
+# Audit log entries are queued and written in batches by a background thread
+LOG_BATCH_SIZE = 100
+LOG_WRITE_RETRIES = 3
+_log_queue = queue.Queue()
+_failed_log_entries = []  # entries that could not be written even row by row
+_log_worker = None
+_log_worker_lock = threading.Lock()
 
 def authenticate_user(username, password):
     """Authenticate user with bcrypt hashing (CIA confidentiality)"""
@@ -27,8 +39,71 @@ def check_role(session_state, required_roles):
         return False
     return session_state['user']['role'] in required_roles
 
+def _log_writer():
+    """Background writer - drain queued log entries into one INSERT batch per commit"""
+    while True:
+        batch = [_log_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_log_batch(batch)
+        finally:
+            for _ in batch:
+                _log_queue.task_done()
+
+def _write_log_batch(batch):
+    """Write a batch in one transaction; on failure retry row by row so one bad row loses nothing else"""
+    try:
+        add_logs(batch)
+        return
+    except Exception as e:
+        print(f"Audit log batch error, retrying row by row: {e}")
+    
+    for entry in batch:
+        error = _write_log_entry(entry)
+        if error:
+            # Kept and reported (see get_failed_logs) rather than silently dropped
+            _failed_log_entries.append(entry)
+            print(f"Audit log entry not written ({error}): {entry}")
+
+def _write_log_entry(entry):
+    """Write one entry, retrying transient errors; return the error if it could not be written"""
+    for attempt in range(LOG_WRITE_RETRIES):
+        try:
+            add_logs([entry])
+            return None
+        except sqlite3.OperationalError as e:
+            # Transient (e.g. database locked) - back off and retry
+            error = e
+            time.sleep(0.1 * (attempt + 1))
+        except Exception as e:
+            return e
+    return error
+
+def get_failed_logs():
+    """Return audit log entries that could not be written (for display to admins)"""
+    return list(_failed_log_entries)
+
+def _ensure_log_writer():
+    """Start the background log writer once per process"""
+    global _log_worker
+    with _log_worker_lock:
+        if _log_worker is None or not _log_worker.is_alive():
+            _log_worker = threading.Thread(target=_log_writer, name="audit-log-writer", daemon=True)
+            _log_worker.start()
+
+def flush_logs():
+    """Block until all queued log entries are written (so they are visible to readers)"""
+    _ensure_log_writer()
+    _log_queue.join()
+
 def log_user_action(session_state, action, details=""):
     """Log user actions for audit trail (GDPR accountability)"""
     if 'user' in session_state and session_state['user']:
         user = session_state['user']
-        add_log(user['user_id'], user['role'], action, details)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        _ensure_log_writer()
+        _log_queue.put((user['user_id'], user['role'], action, timestamp, details))
@@ -1,4 +1,4 @@
-from cryptography.fernet import Fernet
+from functools import lru_cache
 import os
 
 # Generate or load Fernet key (store securely in production - not hardcoded)
@@ -6,6 +6,7 @@ KEY_FILE = "fernet.key"
 
 def get_or_create_key():
     """Generate or load Fernet encryption key (bonus feature)"""
+    from cryptography.fernet import Fernet  # lazy - not needed for masking helpers
     if os.path.exists(KEY_FILE):
         with open(KEY_FILE, 'rb') as f:
             return f.read()
@@ -15,8 +16,13 @@ def get_or_create_key():
             f.write(key)
         return key
 
+@lru_cache(maxsize=1)
 def get_cipher():
-    """Return Fernet cipher for reversible encryption (GDPR pseudonymisation Article 4(5))"""
+    """Return Fernet cipher for reversible encryption (GDPR pseudonymisation Article 4(5))
+
+    The key is loaded once per process; later calls return the same cipher.
+    """
+    from cryptography.fernet import Fernet
     key = get_or_create_key()
     return Fernet(key)
 
@@ -24,11 +30,23 @@ def mask_name(patient_id):
     """Generate anonymized name (GDPR data minimization)"""
     return f"ANON_{patient_id:04d}"
 
+CONTACT_MASK_PREFIX = "XXX-XXX-"
+CONTACT_MASK_EMPTY = CONTACT_MASK_PREFIX + "XXXX"
+
 def mask_contact(contact):
     """Mask contact number for confidentiality (CIA triad)"""
-    if len(contact) >= 4:
-        return "XXX-XXX-" + contact[-4:]
-    return "XXX-XXX-XXXX"
+    return CONTACT_MASK_PREFIX + contact[-4:] if len(contact) >= 4 else CONTACT_MASK_EMPTY
+
+def mask_contacts(contacts):
+    """Mask a batch of contact numbers (batch anonymization)"""
+    return [mask_contact(contact) for contact in contacts]
+
+def encrypt_fields(cipher, values):
+    """Fernet-encrypt a batch of text fields; empty strings when no cipher is given"""
+    if not cipher:
+        return [""] * len(values)
+    encrypt = cipher.encrypt
+    return [encrypt(value.encode()).decode() for value in values]
 
 def decrypt_field(cipher, encrypted_value):
     """Decrypt Fernet-encrypted field (Admin only, logged action)"""
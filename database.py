@@ -1,25 +1,75 @@
+import atexit
 import sqlite3
+import threading
 import bcrypt
 from datetime import datetime
 from contextlib import contextmanager
+from crypto_utils import mask_name, mask_contacts, encrypt_fields
 
 DATABASE = "hospital.db"
 
-@contextmanager
-def get_db_connection():
-    """Context manager for database connections with foreign keys enabled"""
+# Patient data version, bumped on every write so cached reads can be invalidated
+_patients_version = 0
+
+def get_patients_version():
+    """Return current patient data version (changes on every patient write)"""
+    return _patients_version
+
+def _bump_patients_version():
+    """Invalidate cached patient reads after a write"""
+    global _patients_version
+    _patients_version += 1
+
+# Small shared pool of open connections (Streamlit runs each rerun on a new thread)
+DB_POOL_SIZE = 4
+_pool = []
+_pool_lock = threading.Lock()
+
+def _open_connection():
+    """Open a connection with foreign keys and WAL-friendly settings"""
     conn = sqlite3.connect(DATABASE, check_same_thread=False)
     # Enable foreign key constraints per connection as required by SQLite
     conn.execute("PRAGMA foreign_keys = ON;")
+    # Safe with WAL, and avoids an fsync on every commit
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
     conn.row_factory = sqlite3.Row
+    return conn
+
+@contextmanager
+def get_db_connection():
+    """Context manager that borrows a pooled database connection"""
+    with _pool_lock:
+        conn = _pool.pop() if _pool else None
+    if conn is None:
+        conn = _open_connection()
     try:
         yield conn
     finally:
-        conn.close()
+        # Never hand out a connection with an open transaction
+        if conn.in_transaction:
+            conn.rollback()
+        with _pool_lock:
+            if len(_pool) < DB_POOL_SIZE:
+                _pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+def close_all_connections():
+    """Close every pooled connection (registered to run at interpreter exit)"""
+    with _pool_lock:
+        while _pool:
+            _pool.pop().close()
+
+atexit.register(close_all_connections)
 
 def init_database():
     """Initialize database schema and seed default users"""
     with get_db_connection() as conn:
+        # WAL lets readers run concurrently with the audit log writer (persists in the DB file)
+        conn.execute("PRAGMA journal_mode = WAL;")
         cursor = conn.cursor()
         
         # Create users table with role constraints for RBAC
@@ -80,50 +130,112 @@ def init_database():
         conn.commit()
         print("✅ Database initialized with foreign key constraints enabled")
 
-def add_log(user_id, role, action, details=""):
-    """Add audit log entry for accountability (GDPR Article 5)"""
+def add_logs(entries):
+    """Add a batch of audit log entries in a single transaction (GDPR Article 5)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute(
+        cursor.executemany(
             "INSERT INTO logs (user_id, role, action, timestamp, details) VALUES (?, ?, ?, ?, ?)",
-            (user_id, role, action, timestamp, details)
+            entries
         )
         conn.commit()
 
-def get_all_patients():
-    """Retrieve all patients for availability"""
+def count_patients():
+    """Count patient records (for pagination)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM patients ORDER BY date_added DESC")
-        return cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM patients")
+        return cursor.fetchone()[0]
 
-def get_all_logs():
-    """Retrieve audit logs for integrity verification (Admin only)"""
+def get_patients_page(offset, limit):
+    """Retrieve one page of patients (newest first) as (columns, rows)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT l.log_id, l.user_id, u.username, l.role, l.action, 
-                   l.timestamp, l.details
-            FROM logs l
-            LEFT JOIN users u ON l.user_id = u.user_id
-            ORDER BY l.timestamp DESC
-        """)
-        return cursor.fetchall()
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT * FROM patients ORDER BY patient_id DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        )
+        columns = [col[0] for col in cursor.description]
+        return columns, cursor.fetchall()
+
+def get_patient_ids():
+    """Retrieve all patient IDs (newest first) for selectors"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT patient_id FROM patients ORDER BY patient_id DESC")
+        return [row[0] for row in cursor.fetchall()]
 
-def add_patient(name, contact, diagnosis, anon_name, anon_contact, enc_name="", enc_contact=""):
+def get_patient_by_id(patient_id):
+    """Retrieve a single patient by primary key"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM patients WHERE patient_id=?", (patient_id,))
+        return cursor.fetchone()
+
+def iter_patients(batch_size=1000):
+    """Stream all patients as (columns, rows) batches without loading the whole table"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute("SELECT * FROM patients ORDER BY patient_id DESC")
+        columns = [col[0] for col in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield columns, rows
+
+# Shared audit log SELECT (with username) for the log page and export
+_LOGS_SELECT = """
+    SELECT l.log_id, l.user_id, u.username, l.role, l.action, 
+           l.timestamp, l.details
+    FROM logs l
+    LEFT JOIN users u ON l.user_id = u.user_id
+"""
+
+def iter_logs(max_log_id, batch_size=1000):
+    """Stream audit logs up to max_log_id (newest first) as (columns, rows) batches for export"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(_LOGS_SELECT + " WHERE l.log_id <= ? ORDER BY l.timestamp DESC", (max_log_id,))
+        columns = [col[0] for col in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield columns, rows
+
+def get_logs_since(last_log_id, limit):
+    """Retrieve up to `limit` newest audit logs after last_log_id, oldest first, as (columns, rows)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT * FROM (" + _LOGS_SELECT + " WHERE l.log_id > ? ORDER BY l.log_id DESC LIMIT ?) ORDER BY log_id",
+            (last_log_id, limit)
+        )
+        columns = [col[0] for col in cursor.description]
+        return columns, cursor.fetchall()
+
+def add_patient(name, contact, diagnosis, anon_contact, enc_name="", enc_contact=""):
     """Add new patient with anonymization (GDPR data minimization)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         date_added = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cursor.execute("""
             INSERT INTO patients 
-            (name, contact, diagnosis, anonymized_name, anonymized_contact, 
+            (name, contact, diagnosis, anonymized_contact, 
              encrypted_name, encrypted_contact, date_added)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (name, contact, diagnosis, anon_name, anon_contact, enc_name, enc_contact, date_added))
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (name, contact, diagnosis, anon_contact, enc_name, enc_contact, date_added))
+        # Anonymized name depends on the new ID - set it in the same transaction
+        pid = cursor.lastrowid
+        cursor.execute("UPDATE patients SET anonymized_name=? WHERE patient_id=?", (mask_name(pid), pid))
         conn.commit()
-        return cursor.lastrowid
+        _bump_patients_version()
+        return pid
 
 def update_patient(patient_id, name, contact, diagnosis, anon_name, anon_contact):
     """Update patient record with validation (CIA integrity)"""
@@ -135,6 +247,7 @@ def update_patient(patient_id, name, contact, diagnosis, anon_name, anon_contact
             WHERE patient_id=?
         """, (name, contact, diagnosis, anon_name, anon_contact, patient_id))
         conn.commit()
+        _bump_patients_version()
 
 def anonymize_all_patients(cipher):
     """Batch anonymize all patients with optional encryption (bonus feature)"""
@@ -143,19 +256,23 @@ def anonymize_all_patients(cipher):
         cursor.execute("SELECT patient_id, name, contact FROM patients")
         patients = cursor.fetchall()
         
-        for patient in patients:
-            pid = patient['patient_id']
-            anon_name = f"ANON_{pid:04d}"
-            anon_contact = "XXX-XXX-" + patient['contact'][-4:] if len(patient['contact']) >= 4 else "XXX-XXX-XXXX"
-            
-            # Optional Fernet encryption for reversible anonymization (bonus)
-            enc_name = cipher.encrypt(patient['name'].encode()).decode() if cipher else ""
-            enc_contact = cipher.encrypt(patient['contact'].encode()).decode() if cipher else ""
-            
-            cursor.execute("""
-                UPDATE patients 
-                SET anonymized_name=?, anonymized_contact=?, encrypted_name=?, encrypted_contact=?
-                WHERE patient_id=?
-            """, (anon_name, anon_contact, enc_name, enc_contact, pid))
+        # Mask and encrypt column-wise instead of per row
+        pids = [patient['patient_id'] for patient in patients]
+        names = [patient['name'] for patient in patients]
+        contacts = [patient['contact'] for patient in patients]
+        anon_names = [mask_name(pid) for pid in pids]
+        anon_contacts = mask_contacts(contacts)
+        
+        # Optional Fernet encryption for reversible anonymization (bonus)
+        enc_names = encrypt_fields(cipher, names)
+        enc_contacts = encrypt_fields(cipher, contacts)
+        
+        # Single executemany in one transaction - one commit for the whole batch
+        cursor.executemany("""
+            UPDATE patients 
+            SET anonymized_name=?, anonymized_contact=?, encrypted_name=?, encrypted_contact=?
+            WHERE patient_id=?
+        """, zip(anon_names, anon_contacts, enc_names, enc_contacts, pids))
         
         conn.commit()
+        _bump_patients_version()